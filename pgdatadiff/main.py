@@ -1,6 +1,6 @@
 """
 Usage:
-  pgdatadiff --firstdb=<firstconnectionstring> --seconddb=<secondconnectionstring> [--only-data|--only-sequences] [--count-only] [--chunk-size=<size>] [--check-columns=<column> ...]
+  pgdatadiff --firstdb=<firstconnectionstring> --seconddb=<secondconnectionstring> [--only-data|--only-sequences] [--count-only] [--fdw] [--chunk-size=<size>] [--check-columns=<column> ...]
   pgdatadiff --version
 
 Options:
@@ -11,7 +11,8 @@ Options:
   --only-data        Only compare data, exclude sequences
   --only-sequences   Only compare seqences, exclude data
   --count-only       Do a quick test based on counts alone
-  --chunk-size=10000       The chunk size when comparing data [default: 10000]
+  --fdw              Compare tables with a postgres_fdw join run by the first DB, falling back to hashing if it can't be set up
+  --chunk-size=10000       The initial chunk size when comparing data, adjusted as the comparison goes [default: 10000]
   --check-columns=column-name    Restrict check to given columns. Repeat to add multiple columns. Primary key is always checked.
 """
 
@@ -36,7 +37,8 @@ def main():
     differ = DBDiff(first_db_connection_string, second_db_connection_string,
                     chunk_size=arguments['--chunk-size'],
                     count_only=arguments['--count-only'],
-                    check_columns=arguments['--check-columns']
+                    check_columns=arguments['--check-columns'],
+                    fdw=arguments['--fdw']
                     )
 
     if not arguments['--only-sequences']:
@@ -1,20 +1,79 @@
+import os
+import re
+import threading
+import time
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from fabulous.color import bold, green, red
 from halo import Halo
+from psycopg2.extensions import QueryCanceledError
 from sqlalchemy import exc as sa_exc
 from sqlalchemy.engine import create_engine
-from sqlalchemy.exc import NoSuchTableError, ProgrammingError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, NoSuchTableError
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm.scoping import scoped_session
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.sql.schema import MetaData, Table
 
 
-def make_session(connection_string):
+# Row hashes are combined by summing them as 64 bit integers, which streams
+# through a plain aggregate instead of materialising the whole chunk.
+HASH_AGGREGATES = {
+    "md5": "sum(('x' || substr(h, 1, 16))::bit(64)::bigint) || ':' || "
+           "sum(('x' || substr(h, 17, 16))::bit(64)::bigint)",
+    "xxh64": "sum(('x' || h)::bit(64)::bigint)::varchar",
+}
+
+
+# Chunk sizes adapt so that hashing a chunk takes about this long.
+TARGET_CHUNK_SECONDS = 0.25
+MIN_CHUNK_SIZE = 1000
+MAX_CHUNK_SIZE = 200000
+
+
+def make_session(connection_string, pool_size=5):
     engine = create_engine(connection_string, echo=False,
-                           convert_unicode=True)
-    Session = sessionmaker(bind=engine)
-    return Session(), engine
+                           convert_unicode=True, pool_size=pool_size)
+    Session = scoped_session(sessionmaker(bind=engine))
+    return Session, engine
+
+
+def quote_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def quote_ident(value):
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def execute_statement(connection, query, params=None):
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+
+def execute_fetchone(connection, query, params=None):
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchone()
+
+
+def cancel_future(connection, future):
+    if not future.cancel() and future.running():
+        connection.cancel()
+
+
+def deallocate_hash(connection):
+    try:
+        connection.rollback()
+        execute_statement(connection, "DEALLOCATE pgdd_hash;")
+    except QueryCanceledError:
+        # A cancel aimed at a chunk query that had just finished can land
+        # on the cleanup instead; it only ever hits one statement.
+        connection.rollback()
+        execute_statement(connection, "DEALLOCATE pgdd_hash;")
 
 
 class DBDiff(object):
@@ -25,124 +84,346 @@ class DBDiff(object):
         seconddb,
         chunk_size=10000,
         count_only=False,
-        check_columns=None
+        check_columns=None,
+        fdw=False
     ):
-        firstsession, firstengine = make_session(firstdb)
-        secondsession, secondengine = make_session(seconddb)
+        self.seconddb = seconddb
+        self.fdw = fdw
+        self.workers = int(os.environ.get("PGDATADIFF_WORKERS", 8))
+        if self.workers < 1:
+            raise ValueError("PGDATADIFF_WORKERS must be at least 1")
+        firstsession, firstengine = make_session(firstdb, self.workers)
+        secondsession, secondengine = make_session(seconddb, self.workers)
         self.firstsession = firstsession
         self.firstengine = firstengine
         self.secondsession = secondsession
         self.secondengine = secondengine
         self.firstmeta = MetaData(bind=firstengine)
         self.secondmeta = MetaData(bind=secondengine)
+        self._reflect_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._running_connections = set()
+        self._running_lock = threading.Lock()
         self.firstinspector = inspect(firstengine)
         self.secondinspector = inspect(secondengine)
         self.chunk_size = int(chunk_size)
         self.count_only = count_only
-        self.check_columns = check_columns
+        self.check_columns = tuple(check_columns or ())
+        self._check_cols_set = frozenset(self.check_columns)
+        self._pk_cache, self._col_cache = self.get_table_metadata()
+        self._hash_fn = self.get_hash_function()
+        # Don't keep the startup transaction idle on both databases while
+        # the tables are being compared.
+        self.firstsession.remove()
+        self.secondsession.remove()
+
+    def reflect_table(self, tablename):
+        # Workers share the MetaData objects, so reflect one table at a time.
+        with self._reflect_lock:
+            return (Table(tablename, self.firstmeta, autoload=True),
+                    Table(tablename, self.secondmeta, autoload=True))
+
+    def get_hash_function(self):
+        # xxh64 is only used when both databases resolve the same function
+        # and agree on its output, otherwise every chunk would differ.
+        PROBE_XXH64_SQL = "SELECT xxh64('pgdatadiff')::text;"
+        values = []
+        for session in (self.firstsession, self.secondsession):
+            try:
+                values.append(session.execute(PROBE_XXH64_SQL).scalar())
+            except DBAPIError:
+                session.rollback()
+                return "md5"
+        if values[0] == values[1] and \
+                re.fullmatch("[0-9a-fA-F]{16}", values[0] or ""):
+            return "xxh64"
+        return "md5"
+
+    def get_table_metadata(self):
+        # Read from pg_catalog: information_schema only lists constraints of
+        # tables the role owns or can do more than SELECT on.
+        GET_COLUMNS_SQL = """
+        SELECT c.relname, a.attname
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public'
+            AND c.relkind IN ('r', 'p')
+            AND a.attnum > 0
+            AND NOT a.attisdropped
+        ORDER BY c.relname, a.attnum;
+        """
+        GET_PRIMARY_KEYS_SQL = """
+        SELECT c.relname, a.attname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        CROSS JOIN LATERAL unnest(i.indkey::int2[])
+            WITH ORDINALITY AS k(attnum, position)
+        JOIN pg_attribute a
+            ON a.attrelid = c.oid AND a.attnum = k.attnum
+        WHERE i.indisprimary
+            AND n.nspname = 'public'
+        ORDER BY c.relname, k.position;
+        """
+        pks = {}
+        for tablename, column in self.firstsession.execute(
+                GET_PRIMARY_KEYS_SQL).fetchall():
+            pks.setdefault(tablename, []).append(column)
+        columns = {}
+        for tablename, column in self.firstsession.execute(
+                GET_COLUMNS_SQL).fetchall():
+            columns.setdefault(tablename, []).append(column)
+        return pks, columns
 
     def diff_table_data(self, tablename):
         try:
-            firsttable = Table(tablename, self.firstmeta, autoload=True)
+            firsttable, secondtable = self.reflect_table(tablename)
             firstquery = self.firstsession.query(
                 firsttable)
-            secondtable = Table(tablename, self.secondmeta, autoload=True)
             secondquery = self.secondsession.query(
                 secondtable)
-            if firstquery.count() != secondquery.count():
-                return False, f"counts are different" \
-                              f" {firstquery.count()} != {secondquery.count()}"
-            if firstquery.count() == 0:
-                return None, "tables are empty"
             if self.count_only is True:
+                first_count = firstquery.count()
+                second_count = secondquery.count()
+                if first_count != second_count:
+                    return False, f"counts are different" \
+                                  f" {first_count} != {second_count}"
+                if first_count == 0:
+                    return None, "tables are empty"
                 return True, "Counts are the same"
-            pk = ",".join(self.firstinspector.get_pk_constraint(tablename)[
-                              'constrained_columns'])
+            # Without --count-only the chunk hashes catch any difference in
+            # row counts, so only emptiness is checked up front.
+            first_empty = not self.firstsession.query(
+                firstquery.exists()).scalar()
+            second_empty = not self.secondsession.query(
+                secondquery.exists()).scalar()
+            if first_empty and second_empty:
+                return None, "tables are empty"
+            if first_empty != second_empty:
+                return False, "only one of the tables is empty"
+            pk = ",".join(self._pk_cache.get(tablename, []))
             if not pk:
                 return None, "no primary key(s) on this table." \
                              " Comparison is not possible."
-            columns = [ x["name"] for x in self.firstinspector.get_columns(tablename)]
-            columns = [x for x in self.check_columns if x in columns]
-            if len(columns) != len(self.check_columns):
+            if self._check_cols_set - set(self._col_cache.get(tablename, [])):
                 return None, "missing checked columns"
 
         except NoSuchTableError:
             return False, "table is missing"
 
+        if self.fdw:
+            result = self.diff_table_data_fdw(tablename, pk)
+            if result is not None:
+                return result
+
         SQL_QUERY_FIRST_PK = f"""
             SELECT {pk} FROM {tablename} ORDER BY {pk} LIMIT 1;
         """
-        prev_cursor = None
         cursor = self.firstsession.execute(SQL_QUERY_FIRST_PK).scalar()
 
         if cursor != self.secondsession.execute(SQL_QUERY_FIRST_PK).scalar():
             return False, "first primary keys are different"
 
 
-        SQL_QUERY_CURSOR = f"""
-        SELECT {pk} FROM(
-            SELECT {pk}
-            FROM {tablename}
-            WHERE {pk} >= :cursor
-            ORDER BY {pk} ASC
-            LIMIT :row_limit) s
-        ORDER BY {pk} DESC
-        LIMIT 1;
-        """
-
         if self.check_columns:
             columns = f"{pk}, {', '.join(self.check_columns)}"
         else:
             columns = 't.*'
-        SQL_TEMPLATE_HASH = f"""
-        SELECT md5(array_agg(md5(({columns})::varchar))::varchar)
-        FROM (
-                SELECT *
-                FROM {tablename}
-                WHERE {pk} >= :cursor
-                ORDER BY {pk} ASC
-                limit :row_limit
-            ) AS t;
+
+        # ORDER BY is still needed so LIMIT selects the same rows on both
+        # sides. The chunk's last primary key comes back with the hash and
+        # the next chunk starts strictly after it; an empty chunk returns
+        # NULL for both and ends the scan.
+        def hash_sql(comparison):
+            return f"""
+            SELECT {HASH_AGGREGATES[self._hash_fn]}, max({pk})
+            FROM (
+                    SELECT {self._hash_fn}(({columns})::varchar) AS h, {pk}
+                    FROM {tablename} AS t
+                    WHERE {pk} {comparison} %(cursor)s
+                    ORDER BY {pk} ASC
+                    limit %(row_limit)s
+                ) AS s;
+            """
+
+        SQL_QUERY_FIRST_HASH = hash_sql(">=")
+        # The hash query of the following chunks is prepared once per table
+        # so that every chunk reuses the same parsed statement and plan.
+        SQL_PREPARE_HASH = "PREPARE pgdd_hash AS " + hash_sql(">") \
+            .replace("%(cursor)s", "$1").replace("%(row_limit)s", "$2")
+        SQL_EXECUTE_HASH = "EXECUTE pgdd_hash(%(cursor)s, %(row_limit)s);"
+        # The chunk loop talks to psycopg2 directly on the sessions' own
+        # connections, skipping SQLAlchemy's per-statement overhead.
+        firstconnection = self.firstsession.connection().connection
+        secondconnection = self.secondsession.connection().connection
+        prepared = []
+        try:
+            for connection in (firstconnection, secondconnection):
+                execute_statement(connection, SQL_PREPARE_HASH)
+                prepared.append(connection)
+            # Each connection has its own single worker so its queries run
+            # in submission order. The next chunk is queued on both
+            # databases as soon as the first one returns its last primary
+            # key, before the current chunk is compared, so at most two
+            # chunks are in flight per database.
+            with ThreadPoolExecutor(max_workers=1) as firstexecutor, \
+                    ThreadPoolExecutor(max_workers=1) as secondexecutor:
+
+                def submit_chunk(query, cursor, chunk_size):
+                    params = {"row_limit": chunk_size, "cursor": cursor}
+                    return (cursor, chunk_size,
+                            firstexecutor.submit(execute_fetchone,
+                                                 firstconnection,
+                                                 query, params),
+                            secondexecutor.submit(execute_fetchone,
+                                                  secondconnection,
+                                                  query, params))
+
+                min_chunk_size = min(MIN_CHUNK_SIZE, self.chunk_size)
+                started = time.monotonic()
+                pending = deque([
+                    submit_chunk(SQL_QUERY_FIRST_HASH, cursor,
+                                 self.chunk_size)])
+                while pending:
+                    cursor, chunk_size, firstfuture, secondfuture = \
+                        pending.popleft()
+                    firstresult, next_cursor = firstfuture.result()
+                    if next_cursor is not None:
+                        elapsed = max(time.monotonic() - started, 0.001)
+                        started = time.monotonic()
+                        next_chunk_size = min(max(
+                            int(TARGET_CHUNK_SECONDS * chunk_size / elapsed),
+                            min_chunk_size), MAX_CHUNK_SIZE)
+                        pending.append(submit_chunk(
+                            SQL_EXECUTE_HASH, next_cursor, next_chunk_size))
+                    secondresult, _ = secondfuture.result()
+                    if firstresult != secondresult or self._stop.is_set():
+                        # Don't wait for the next chunk that is already
+                        # queued: drop it, or cancel it if it's running.
+                        for _, _, firstnext, secondnext in pending:
+                            cancel_future(firstconnection, firstnext)
+                            cancel_future(secondconnection, secondnext)
+                    if firstresult != secondresult:
+                        return False, f"data is different - start_cursor" \
+                                      f" {cursor} - with {chunk_size}"
+                    if self._stop.is_set():
+                        return None, "analysis aborted"
+        finally:
+            # Prepared statements outlive transactions and the connections
+            # go back to the pool, so always drop them. Rolling back first
+            # keeps a failed chunk query from making DEALLOCATE fail too.
+            for connection in prepared:
+                deallocate_hash(connection)
+        return True, "data is identical."
+
+    def diff_table_data_fdw(self, tablename, pk):
+        if self.check_columns:
+            columns = self._pk_cache[tablename] + list(self.check_columns)
+            first_row = ", ".join(f"l.{x}" for x in columns)
+            second_row = ", ".join(f"r.{x}" for x in columns)
+        else:
+            first_row, second_row = "l.*", "r.*"
+        SQL_QUERY_DIVERGING_PKS = f"""
+        SELECT {pk}
+        FROM {tablename} AS l
+        FULL OUTER JOIN pgdatadiff_fdw.{tablename} AS r USING ({pk})
+        WHERE ROW({first_row})::varchar IS DISTINCT FROM
+            ROW({second_row})::varchar
+        ORDER BY {pk}
+        LIMIT 10;
         """
-        while prev_cursor != cursor:
-            firstresult = self.firstsession.execute(
-                SQL_TEMPLATE_HASH,
-                {"row_limit": self.chunk_size,
-                 "cursor": cursor}).scalar()
-            secondresult = self.secondsession.execute(
-                SQL_TEMPLATE_HASH,
-                {"row_limit": self.chunk_size,
-                 "cursor": cursor}).scalar()
-            if firstresult != secondresult:
-                return False, f"data is different - start_cursor {cursor} -" \
-                              f" with {self.chunk_size}"
-            prev_cursor = cursor
-            cursor = self.firstsession.execute(
-               SQL_QUERY_CURSOR,
-               {"row_limit": self.chunk_size,
-                "cursor": cursor}).scalar()
+        try:
+            rows = self.firstsession.execute(
+                SQL_QUERY_DIVERGING_PKS).fetchall()
+        except DBAPIError:
+            # Fall back to hashing for this table.
+            self.firstsession.rollback()
+            return None
+        if rows:
+            pks = ", ".join(
+                str(row[0]) if len(row) == 1 else str(tuple(row))
+                for row in rows)
+            return False, f"data is different - first diverging keys: {pks}"
         return True, "data is identical."
 
+    def setup_fdw(self):
+        url = make_url(self.seconddb)
+        server_options = {"dbname": url.database, "host": url.host,
+                          "port": url.port}
+        user_options = {"user": url.username, "password": url.password}
+        server_options = ", ".join(
+            f"{k} {quote_literal(v)}" for k, v in server_options.items() if v)
+        user_options = ", ".join(
+            f"{k} {quote_literal(v)}" for k, v in user_options.items() if v)
+        SETUP_FDW_SQL = [
+            "CREATE EXTENSION IF NOT EXISTS postgres_fdw;",
+            "DROP SERVER IF EXISTS pgdatadiff_server CASCADE;",
+            f"CREATE SERVER pgdatadiff_server FOREIGN DATA WRAPPER "
+            f"postgres_fdw OPTIONS ({server_options});",
+            f"CREATE USER MAPPING FOR CURRENT_USER SERVER pgdatadiff_server"
+            f" OPTIONS ({user_options});" if user_options else
+            "CREATE USER MAPPING FOR CURRENT_USER SERVER pgdatadiff_server;",
+            "DROP SCHEMA IF EXISTS pgdatadiff_fdw CASCADE;",
+            "CREATE SCHEMA pgdatadiff_fdw;",
+            "IMPORT FOREIGN SCHEMA public FROM SERVER pgdatadiff_server"
+            " INTO pgdatadiff_fdw;",
+        ]
+        try:
+            for statement in SETUP_FDW_SQL:
+                self.firstsession.execute(statement)
+            self.firstsession.commit()
+        except DBAPIError as e:
+            self.firstsession.rollback()
+            print(red(f"Could not set up postgres_fdw, falling back to"
+                      f" hashing: {e.orig}"))
+            return False
+        return True
+
+    def teardown_fdw(self):
+        try:
+            self.firstsession.execute("DROP SCHEMA pgdatadiff_fdw CASCADE;")
+            self.firstsession.execute(
+                "DROP SERVER pgdatadiff_server CASCADE;")
+            self.firstsession.commit()
+        except DBAPIError as e:
+            self.firstsession.rollback()
+            print(red(f"Could not clean up postgres_fdw: {e.orig}"))
+
     def get_all_sequences(self):
         GET_SEQUENCES_SQL = """SELECT c.relname FROM
         pg_class c WHERE c.relkind = 'S';"""
         return [x[0] for x in
                 self.firstsession.execute(GET_SEQUENCES_SQL).fetchall()]
 
-    def diff_sequence(self, seq_name):
-        GET_SEQUENCES_VALUE_SQL = f"SELECT last_value FROM {seq_name};"
-
+    def get_sequence_values(self, session, sequences):
+        GET_VISIBLE_SEQUENCES_SQL = """SELECT c.relname FROM
+        pg_class c WHERE c.relkind = 'S' AND pg_table_is_visible(c.oid)
+        AND has_sequence_privilege(c.oid, 'SELECT');"""
+        visible = {x[0] for x in
+                   session.execute(GET_VISIBLE_SEQUENCES_SQL).fetchall()}
+        queries = [
+            f"SELECT {quote_literal(x)} AS n, last_value FROM {quote_ident(x)}"
+            for x in sequences if x in visible]
+        if not queries:
+            return {}
         try:
-            firstvalue = \
-                self.firstsession.execute(GET_SEQUENCES_VALUE_SQL).fetchone()[
-                    0]
-            secondvalue = \
-                self.secondsession.execute(GET_SEQUENCES_VALUE_SQL).fetchone()[
-                    0]
-        except ProgrammingError:
-            self.firstsession.rollback()
-            self.secondsession.rollback()
+            return dict(session.execute(" UNION ALL ".join(queries))
+                        .fetchall())
+        except DBAPIError:
+            session.rollback()
+        # One unreadable sequence fails the whole UNION, so read them one
+        # at a time and leave out the ones that fail.
+        values = {}
+        for query in queries:
+            try:
+                values.update(session.execute(query).fetchall())
+            except DBAPIError:
+                session.rollback()
+        return values
 
+    def diff_sequence(self, seq_name, firstvalue, secondvalue):
+        if firstvalue is None or secondvalue is None:
             return False, "sequence doesnt exist in second database."
         if firstvalue < secondvalue:
             return None, f"first sequence is less than" \
@@ -155,13 +436,17 @@ class DBDiff(object):
     def diff_all_sequences(self):
         print(bold(red('Starting sequence analysis.')))
         sequences = sorted(self.get_all_sequences())
+        firstvalues = self.get_sequence_values(self.firstsession, sequences)
+        secondvalues = self.get_sequence_values(self.secondsession, sequences)
         failures = 0
-        for sequence in sequences:
+        for i, sequence in enumerate(sequences, 1):
             with Halo(
                     text=f"Analysing sequence {sequence}. "
-                         f"[{sequences.index(sequence) + 1}/{len(sequences)}]",
+                         f"[{i}/{len(sequences)}]",
                     spinner='dots') as spinner:
-                result, message = self.diff_sequence(sequence)
+                result, message = self.diff_sequence(
+                    sequence, firstvalues.get(sequence),
+                    secondvalues.get(sequence))
                 if result is True:
                     spinner.succeed(f"{sequence} - {message}")
                 elif result is None:
@@ -174,28 +459,70 @@ class DBDiff(object):
             return 1
         return 0
 
+    def _diff_table_data_task(self, tablename):
+        connections = (self.firstsession.connection().connection,
+                       self.secondsession.connection().connection)
+        with self._running_lock:
+            self._running_connections.update(connections)
+        try:
+            if self._stop.is_set():
+                return None, "analysis aborted"
+            return self.diff_table_data(tablename)
+        finally:
+            with self._running_lock:
+                self._running_connections.difference_update(connections)
+            self.firstsession.remove()
+            self.secondsession.remove()
+
+    def _abort_table_tasks(self, futures):
+        self._stop.set()
+        for future in futures:
+            future.cancel()
+        with self._running_lock:
+            for connection in self._running_connections:
+                connection.cancel()
+
     def diff_all_table_data(self):
         failures = 0
         print(bold(red('Starting table analysis.')))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=sa_exc.SAWarning)
-            tables = sorted(
-                self.firstinspector.get_table_names(schema="public"))
-            for table in tables:
-                with Halo(
-                        text=f"Analysing table {table}. "
-                             f"[{tables.index(table) + 1}/{len(tables)}]",
-                        spinner='dots') as spinner:
-                    result, message = self.diff_table_data(table)
-                    if result is True:
-                        spinner.succeed(f"{table} - {message}")
-                    elif result is None:
-                        spinner.warn(f"{table} - {message}")
-                    else:
-                        failures += 1
-                        spinner.fail(f"{table} - {message}")
+        if self.fdw:
+            self.fdw = self.setup_fdw()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=sa_exc.SAWarning)
+                tables = sorted(
+                    self.firstinspector.get_table_names(schema="public"))
+                self._stop.clear()
+                executor = ThreadPoolExecutor(max_workers=self.workers)
+                futures = [
+                    executor.submit(self._diff_table_data_task, table)
+                    for table in tables]
+                try:
+                    for i, (table, future) in enumerate(
+                            zip(tables, futures), 1):
+                        with Halo(
+                                text=f"Analysing table {table}. "
+                                     f"[{i}/{len(tables)}]",
+                                spinner='dots') as spinner:
+                            result, message = future.result()
+                            if result is True:
+                                spinner.succeed(f"{table} - {message}")
+                            elif result is None:
+                                spinner.warn(f"{table} - {message}")
+                            else:
+                                failures += 1
+                                spinner.fail(f"{table} - {message}")
+                except BaseException:
+                    # Stop the running tables between chunks, cancel their
+                    # queries and don't wait for them to finish.
+                    self._abort_table_tasks(futures)
+                    executor.shutdown(wait=False)
+                    raise
+                executor.shutdown()
+        finally:
+            if self.fdw:
+                self.teardown_fdw()
         print(bold(green('Table analysis complete.')))
         if failures > 0:
             return 1
         return 0
-